@@ -1,144 +1,318 @@
 import argparse
+import atexit
+import collections
+import contextlib
 import datetime
+import functools
+import io
 import json
 import os
+import queue
 import re
 import sys
 import textwrap
 import threading
 import traceback
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from typing import Dict, List, Optional, Tuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
 import rich
-from IPython.terminal.embed import InteractiveShellEmbed
-from IPython.utils.capture import capture_output
-from rich.syntax import Syntax
-from traitlets.config import Config
+import rich.console
+
+if TYPE_CHECKING:
+    from IPython.terminal.embed import InteractiveShellEmbed
+    from pygments.lexer import Lexer
+    from rich.syntax import Syntax
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+if orjson is not None:
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+
+class _SafeNameTable(dict):
+    """Lazy str.translate table replacing non-word characters other than "-"."""
+
+    def __missing__(self, codepoint: int) -> str:
+        char = chr(codepoint)
+        self[codepoint] = char if char.isalnum() or char in "_-" else "_"
+        return self[codepoint]
+
 
 ipshell = None
 log_file_path = None
+_log_fd: Optional[int] = None
+_log_queue: "queue.Queue[Tuple[List[str], Dict]]" = queue.Queue()
+_THEME = "one-dark"
+LOG_OUTPUT_LIMIT = 1 << 20
+PARSE_CACHE_MAX_BODY = 8 << 10
+_LOG_TEMPLATE = "```python\n{code}\n```\n\n<output>\n{body}\n</output>\n\n"
+_SAFE_NAME_TABLE = _SafeNameTable()
+_last_traceback: Optional[Tuple[BaseException, str]] = None
 ansi_regex = re.compile(r"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])")
-
-is_executing = False
-execution_lock = threading.Lock()
+ansi_regex_re2 = (
+    re2.compile(rb"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])") if re2 is not None else None
+)
+
+execution_slot: "queue.Queue[None]" = queue.Queue(maxsize=1)
+execution_slot.put_nowait(None)
+_exec_queue: "queue.Queue[Tuple[InteractiveShellEmbed, List[str], str]]" = queue.Queue()
+
+_HEALTH_JSON = b'{"status": "alive"}'
+_ACCEPT_JSON = b'{"status": "Execution request accepted"}'
+_BUSY_JSON = b'{"error": "Server is busy executing previous code"}'
+_RESET_JSON = b'{"status": "ok"}'
+
+
+class TeeIO(io.TextIOBase):
+    """Passes writes through to a stream, keeping the last `limit` chars for the log."""
+
+    def __init__(self, stream, limit: int = LOG_OUTPUT_LIMIT) -> None:
+        self._stream = stream
+        self._limit = limit
+        self._chunks: "collections.deque[str]" = collections.deque()
+        self._size = 0
+        self.truncated = False
+
+    @property
+    def encoding(self):
+        return getattr(self._stream, "encoding", "utf-8")
+
+    def writable(self) -> bool:
+        return True
+
+    def isatty(self) -> bool:
+        return self._stream.isatty()
+
+    def fileno(self) -> int:
+        return self._stream.fileno()
+
+    def flush(self) -> None:
+        self._stream.flush()
+
+    def write(self, s: str) -> int:
+        self._stream.write(s)
+        self._chunks.append(s)
+        self._size += len(s)
+        excess = self._size - self._limit
+        while excess > 0:
+            head = self._chunks[0]
+            if len(head) <= excess:
+                self._chunks.popleft()
+                excess -= len(head)
+            else:
+                self._chunks[0] = head[excess:]
+                excess = 0
+            self.truncated = True
+        self._size = min(self._size, self._limit)
+        return len(s)
+
+    def getvalue(self) -> str:
+        text = "".join(self._chunks)
+        return "[... truncated ...]\n" + text if self.truncated else text
 
 
 def strip_ansi_codes(text: str) -> str:
     """Removes ANSI escape codes from a string."""
-    return ansi_regex.sub("", text) if text else ""
+    if not text:
+        return ""
+    if "\x1b" not in text:
+        return text
+    if ansi_regex_re2 is not None:
+        raw = text.encode("utf-8", "surrogatepass")
+        return ansi_regex_re2.sub(b"", raw).decode("utf-8", "surrogatepass")
+    return ansi_regex.sub("", text)
 
 
-def format_code(code: List[str]) -> List:
-    cblk = (">> " + "\n   ".join(code)).strip()
-    return Syntax(cblk, "python", theme="one-dark")
+@functools.lru_cache(maxsize=None)
+def _python_lexer() -> "Lexer":
+    from pygments.lexers import PythonLexer
 
+    return PythonLexer()
 
-def validate_code_exc_data(post_data: str) -> Tuple[List[str], Optional[str]]:
+
+def format_code(code_str: str) -> "Syntax":
+    from rich.syntax import Syntax
+
+    cblk = (">> " + code_str.replace("\n", "\n   ")).strip()
+    return Syntax(cblk, _python_lexer(), theme=_THEME)
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_code_exc_data(post_data: bytes) -> Tuple[Tuple[str, ...], Optional[str]]:
     try:
-        raw_data = json.loads(post_data)
+        raw_data = json_loads(post_data)
         code = raw_data.get("code", [])
         if not isinstance(code, list):
             raise ValueError("'code' must be a list of strings")
-        return code, None
+        return tuple(code), None
     except Exception as e:
-        return [], f"Failed to parse request: {e}"
+        return (), f"Failed to parse request: {e}"
+
+
+def validate_code_exc_data(post_data: bytes) -> Tuple[List[str], Optional[str]]:
+    if len(post_data) <= PARSE_CACHE_MAX_BODY:
+        code, error = _parse_code_exc_data(post_data)
+    else:
+        code, error = _parse_code_exc_data.__wrapped__(post_data)
+    return list(code), error
+
+
+@functools.lru_cache(maxsize=32)
+def _dedent(code_lines: Tuple[str, ...]) -> str:
+    return textwrap.dedent("\n".join(code_lines))
+
+
+def join_code_lines(code_lines: List[str]) -> str:
+    """Joins code lines, removing common indentation only when there is any."""
+    if any(line[:1] in (" ", "\t") for line in code_lines):
+        return _dedent(tuple(code_lines))
+    return "\n".join(code_lines)
+
+
+def _format_log_entry(code_lines: List[str], result: Dict) -> str:
+    """Renders a code/result pair as a Markdown log entry (ANSI codes stripped)."""
+    code_str = "\n".join(code_lines)
+    output_str = strip_ansi_codes(result.get("output") or "")
+    error_str = strip_ansi_codes(result.get("error") or "")
+    body = "\n".join(p for p in (output_str, error_str) if p).strip()
+    return _LOG_TEMPLATE.format_map({"code": code_str, "body": body})
+
+
+def _write_log(fd: int, text: str) -> None:
+    """Appends text to the log file with as few write() calls as possible."""
+    data = memoryview(text.encode("utf-8"))
+    while data:
+        data = data[os.write(fd, data) :]
+
+
+def _log_worker(fd: int) -> None:
+    """Drains the log queue, appending each batch of entries with one write."""
+    while True:
+        entries = [_log_queue.get()]
+        while True:
+            try:
+                entries.append(_log_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            _write_log(fd, "".join(_format_log_entry(*e) for e in entries))
+        except Exception as e:
+            rich.print(f"[red]Error writing to log file {log_file_path}: {e}")
+        finally:
+            for _ in entries:
+                _log_queue.task_done()
+
+
+def _close_log() -> None:
+    """Waits for queued log entries to be written, then closes the log file."""
+    global _log_fd
+    # Stop accepting entries first, so a cell finishing during shutdown can't
+    # queue a write to the descriptor after it has been closed.
+    fd, _log_fd = _log_fd, None
+    if fd is None:
+        return
+    _log_queue.join()
+    os.close(fd)
 
 
 def write_to_log(code_lines: List[str], result: Dict) -> None:
-    """Appends the code and result (with ANSI codes stripped) to the log file."""
-    global log_file_path
-    if not log_file_path:
+    """Queues the code and result to be appended to the log file."""
+    if _log_fd is None:
         return
+    _log_queue.put_nowait((code_lines, result))
 
+
+def _release_execution_slot() -> None:
+    """Marks the server as idle; a no-op if it already is."""
     try:
-        code_str = "\n".join(code_lines)
-        output_str = strip_ansi_codes(result.get("output") or "")
-        error_str = strip_ansi_codes(result.get("error") or "")
-
-        log_content = ""
-        if output_str:
-            log_content += output_str
-        if error_str:
-            if log_content:
-                log_content += "\n"
-            log_content += error_str
-
-        with open(log_file_path, "a", encoding="utf-8") as f:
-            f.write(
-                "```python\n"
-                f"{code_str}\n"
-                "```\n\n"
-                "<output>\n"
-                f"{log_content.strip()}\n"
-                "</output>\n\n"
-            )
+        execution_slot.put_nowait(None)
+    except queue.Full:
+        pass
 
-    except Exception as e:
-        rich.print(f"[red]Error writing to log file {log_file_path}: {e}")
+
+def format_exception(exc: BaseException) -> str:
+    """Formats an exception, reusing the text when the same object is raised again."""
+    global _last_traceback
+    cached = _last_traceback
+    if cached is not None and cached[0] is exc:
+        return cached[1]
+    text = "".join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+    _last_traceback = (exc, text)
+    return text
 
 
 def _run_code_in_background(
-    shell_instance: InteractiveShellEmbed, code_lines: List[str], code_str: str
+    shell_instance: "InteractiveShellEmbed", code_lines: List[str], code_str: str
 ) -> None:
     """Executes the code in IPython and handles output/errors."""
-    global is_executing, execution_lock
+    rich.print("\n", format_code(code_str), "\n", end="")
 
-    rich.print("\n", format_code(code_lines), "\n", end="")
-
-    output = None
-    error_output = None
+    stdout_tee = TeeIO(sys.stdout)
+    stderr_tee = TeeIO(sys.stderr)
     result = {}
 
     try:
-        with capture_output() as captured:
-            exec_result = shell_instance.run_cell(
-                code_str, store_history=False, silent=False
-            )
+        with contextlib.redirect_stdout(stdout_tee):
+            with contextlib.redirect_stderr(stderr_tee):
+                exec_result = shell_instance.run_cell(
+                    code_str, store_history=False, silent=False
+                )
 
-        output = captured.stdout
-        error_output = captured.stderr
+        output = stdout_tee.getvalue()
+        error_output = stderr_tee.getvalue()
 
+        # IPython has already printed any traceback, and it is in the tee
+        # buffers; only format one ourselves if nothing was printed at all.
+        extra_error = ""
         if exec_result.error_before_exec:
-            error_output = (
-                error_output or ""
-            ) + f"Error before execution: {exec_result.error_before_exec}"
-        elif exec_result.error_in_exec:
-            if not output and not error_output:
-                error_output = "".join(
-                    traceback.format_exception(
-                        exec_result.error_in_exec.__class__,
-                        exec_result.error_in_exec,
-                        exec_result.error_in_exec.__traceback__,
-                    )
-                )
+            extra_error = f"Error before execution: {exec_result.error_before_exec}"
+        elif exec_result.error_in_exec and not (output or error_output):
+            extra_error = format_exception(exec_result.error_in_exec)
 
-        if output:
-            sys.stdout.write(output)
-            sys.stdout.flush()
-        if error_output:
-            rich.print("[red]", error_output, sep="")
+        if extra_error:
+            rich.print("[red]", extra_error, sep="")
 
-        result = dict(output=output or "", error=error_output or "")
+        result = dict(output=output, error=error_output + extra_error)
 
     except Exception:
         error_output = traceback.format_exc()
-        if output:
-            sys.stdout.write(output)
-            sys.stdout.flush()
         rich.print("[red]Error during background execution:", error_output, sep="")
-        result = dict(output=output or "", error=error_output)
+        result = dict(output=stdout_tee.getvalue(), error=error_output)
 
     finally:
-        with execution_lock:
-            is_executing = False
+        _release_execution_slot()
         write_to_log(code_lines, result)
 
 
+def _exec_worker() -> None:
+    """Runs queued cells one at a time on a single long-lived daemon thread."""
+    while True:
+        _run_code_in_background(*_exec_queue.get())
+
+
 class CodeExecutionHandler(BaseHTTPRequestHandler):
+    # Responses are tiny; set TCP_NODELAY so Nagle never holds them back.
+    disable_nagle_algorithm = True
+
     def do_GET(self) -> None:
         if self.path == "/health":
-            self.send_json_response(200, dict(status="alive"))
+            self.send_json_bytes(200, _HEALTH_JSON)
         else:
             self.send_response(404)
             self.end_headers()
@@ -156,44 +330,39 @@ class CodeExecutionHandler(BaseHTTPRequestHandler):
             self.end_headers()
 
     def execute_code(self) -> None:
-        global ipshell, is_executing, execution_lock
+        global ipshell
         if ipshell is None:
             self.send_json_response(500, dict(error="IPython shell not initialized"))
             return
 
         content_length = int(self.headers["Content-Length"])
         post_data = self.rfile.read(content_length)
-        code, error = validate_code_exc_data(post_data.decode("utf-8"))
+        code, error = validate_code_exc_data(post_data)
         if error is not None:
             self.send_json_response(400, dict(error=error))
             return
 
-        with execution_lock:
-            if is_executing:
-                self.send_json_response(
-                    409, {"error": "Server is busy executing previous code"}
-                )
-                return
-
-            is_executing = True
+        try:
+            execution_slot.get_nowait()
+        except queue.Empty:
+            self.send_json_bytes(409, _BUSY_JSON)
+            return
 
-        self.send_json_response(200, {"status": "Execution request accepted"})
+        self.send_json_bytes(200, _ACCEPT_JSON)
 
-        code_str = textwrap.dedent("\n".join(code))
-        thread = threading.Thread(
-            target=_run_code_in_background, args=(ipshell, code, code_str), daemon=True
-        )
-        thread.start()
+        code_str = join_code_lines(code)
+        _exec_queue.put_nowait((ipshell, code, code_str))
 
     def reset_scope(self) -> None:
-        global ipshell, is_executing, execution_lock
+        global ipshell
         if ipshell:
             ipshell.reset(new_session=True)
+            _release_execution_slot()
+            # Acknowledge first; the console message and log entry can follow.
+            self.send_json_bytes(200, _RESET_JSON)
+
             reset_msg = "Cleared REPL scope (IPython reset)"
             rich.print(f"[bold yellow]{reset_msg}\n")
-            with execution_lock:
-                is_executing = False
-            self.send_json_response(200, dict(status="ok"))
             write_to_log(["# Reset Command Received"], {"output": reset_msg})
         else:
             self.send_json_response(500, dict(error="IPython shell not initialized"))
@@ -202,10 +371,20 @@ class CodeExecutionHandler(BaseHTTPRequestHandler):
         pass
 
     def send_json_response(self, status: int, resp_data: Dict) -> None:
-        self.send_response(status)
-        self.send_header("Content-type", "application/json")
-        self.end_headers()
-        self.wfile.write(json.dumps(resp_data).encode("utf-8"))
+        self.send_json_bytes(status, json_dumps(resp_data))
+
+    def send_json_bytes(self, status: int, body: bytes) -> None:
+        # Status line, headers and body go out in a single write.
+        reason = self.responses.get(status, ("",))[0]
+        head = (
+            f"{self.protocol_version} {status} {reason}\r\n"
+            f"Server: {self.version_string()}\r\n"
+            f"Date: {self.date_time_string()}\r\n"
+            "Content-type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "\r\n"
+        )
+        self.wfile.write(head.encode("latin-1") + body)
 
 
 def get_address(default_port: int = 5000) -> Tuple[str, int]:
@@ -214,31 +393,43 @@ def get_address(default_port: int = 5000) -> Tuple[str, int]:
 
 
 def setup_logging(log_dir: str, log_name: Optional[str]) -> Optional[str]:
-    """Creates log directory and constructs the log file path."""
-    global log_file_path
+    """Creates log directory, opens the log file and starts the log writer."""
+    global log_file_path, _log_fd
     if not log_dir:
         return None
 
+    fd = None
     try:
         target_dir = os.path.join(log_dir, ".pyrepl")
         os.makedirs(target_dir, exist_ok=True)
 
         filename = f"{datetime.datetime.now().strftime('%b%d%Y-%H%M%S')}"
         if log_name:
-            safe_log_name = re.sub(r"[^\w\-]+", "_", log_name)
+            safe_log_name = log_name.translate(_SAFE_NAME_TABLE)
             filename += f"-{safe_log_name}"
         filename += ".md"
 
         log_file_path = os.path.join(target_dir, filename)
         rich.print(f"[blue]Logging enabled. Log file: {log_file_path}")
-        with open(log_file_path, "a", encoding="utf-8") as f:
-            f.write(f"# PyREPL Session Log: {datetime.datetime.now()}\n")
-            f.write(f"# CWD: {log_dir}\n")
-            if log_name:
-                f.write(f"# Session Name: {log_name}\n")
-            f.write("\n")
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_CLOEXEC", 0)
+        fd = os.open(log_file_path, flags, 0o644)
+        header = f"# PyREPL Session Log: {datetime.datetime.now()}\n"
+        header += f"# CWD: {log_dir}\n"
+        if log_name:
+            header += f"# Session Name: {log_name}\n"
+        _write_log(fd, header + "\n")
+
+        threading.Thread(
+            target=_log_worker, args=(fd,), name="pyrepl-log", daemon=True
+        ).start()
+        atexit.register(_close_log)
+        # Only publish the fd once the writer is running, so write_to_log()
+        # never queues entries that nothing will consume.
+        _log_fd = fd
         return log_file_path
     except Exception as e:
+        if fd is not None:
+            os.close(fd)
         rich.print(f"[red]Failed to setup logging in {log_dir}: {e}")
         return None
 
@@ -250,17 +441,36 @@ def run_server(args):
     log_file_path = setup_logging(args.log_dir, args.log_name)
 
     try:
+        # Bind and start answering before the (slow) IPython import, so a busy
+        # port fails fast and /health responds during startup; /execute and
+        # /reset return 500 until `ipshell` is set below. ThreadingHTTPServer
+        # handles each request on a daemon thread (daemon_threads = True), so
+        # /health never waits behind another request.
+        httpd = ThreadingHTTPServer(addr, CodeExecutionHandler)
+        server_thread = threading.Thread(
+            target=httpd.serve_forever, name="pyrepl-http", daemon=True
+        )
+        server_thread.start()
+
+        from IPython.terminal.embed import InteractiveShellEmbed
+        from traitlets.config import Config
+
         config = Config()
-        ipshell = InteractiveShellEmbed(config=config, banner1="", exit_msg="")
+        shell = InteractiveShellEmbed(config=config, banner1="", exit_msg="")
 
         rich.print("[blue]Initializing IPython & loading default extensions...")
-        ipshell.run_cell("%load_ext autoreload", store_history=False, silent=True)
-        ipshell.run_cell("%autoreload 2", store_history=False, silent=True)
+        shell.run_cell(
+            "%load_ext autoreload\n%autoreload 2", store_history=False, silent=True
+        )
+        # Build the lexer and render once so the first /execute isn't slowed down.
+        rich.console.Console(file=io.StringIO()).print(format_code("pass"))
+
+        threading.Thread(target=_exec_worker, name="pyrepl-exec", daemon=True).start()
+        ipshell = shell
 
         rich.print(f"[bold blue]Server running on http://{addr[0]}:{addr[1]}")
 
-        httpd = HTTPServer(addr, CodeExecutionHandler)
-        httpd.serve_forever()
+        server_thread.join()
 
     except KeyboardInterrupt:
         rich.print("\n[bold blue] exiting...")